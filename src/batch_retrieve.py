@@ -1,20 +1,37 @@
 from pathlib import Path
 import json
+import numpy as np
 import faiss
 from sentence_transformers import SentenceTransformer
 from rerank import rerank
+from index_faiss import N_SHARDS, PAGES_INDEX_PATH, PAGES_META_PATH
+from sharded_search import ShardedSearcher, count_shards
+from chunk_store import RETRIEVED_IDS_PATH, ChunkStore, chunks_fingerprint, resolve_hits, to_compact
 
 
 BASE_DIR = Path(__file__).resolve().parents[1]
 INDEX_PATH = BASE_DIR / "data" / "faiss.index"
-META_PATH = BASE_DIR / "data" / "faiss_meta.jsonl"
 CHUNKS_PATH = BASE_DIR / "data" / "chunks.jsonl"
 
 # TODO: поставь правильное имя файла с вопросами:
 QUESTIONS_PATH = BASE_DIR / "data" / "questions.json"
 
-OUT_PATH = BASE_DIR / "data" / "retrieved.jsonl"
+OUT_PATH = RETRIEVED_IDS_PATH
+# старый формат с текстом чанков в каждом хите (retrieved.jsonl), обычно не нужен
+WRITE_LEGACY = False
+LEGACY_OUT_PATH = BASE_DIR / "data" / "retrieved.jsonl"
 MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+QUERY_BATCH = 64
+
+# двухэтапный поиск: страницы (faiss_pages.index) -> чанки внутри лучших страниц.
+# Нужен faiss_pages.index от index_faiss.py; хитов не больше PAGE_TOP * CHUNKS_PER_PAGE, а не k
+TWO_STAGE = False
+PAGE_TOP = 10
+# PAGE_AGG — как сводить скоры чанков страницы: "max" | "sum". Он задаёт только
+# порядок страниц (page_rank / pages); сами хиты после отбора страниц идут
+# общим списком по скору чанка, чтобы срез top-k в main.py брал лучшие чанки
+PAGE_AGG = "max"
+CHUNKS_PER_PAGE = 3
 
 def read_jsonl(path: Path):
     with path.open("r", encoding="utf-8") as f:
@@ -38,53 +55,137 @@ def load_questions(path: Path):
             return q
     raise ValueError("Не понял формат questions.json")
 
-def main():
+def open_searcher():
+    """
+    Один индекс в процессе или пул шардов (если index_faiss.py писал шарды).
+    У обоих есть .search(qv, k) -> (scores, ids), ids — номера чанков.
+    """
+    if N_SHARDS > 1:
+        if count_shards() != N_SHARDS:
+            raise SystemExit(f"Ожидалось {N_SHARDS} шардов. Запусти index_faiss.py")
+        return ShardedSearcher(N_SHARDS)
     if not INDEX_PATH.exists():
         raise SystemExit("Нет индекса. Запусти index_faiss.py")
+    return faiss.read_index(str(INDEX_PATH))
+
+def score_chunks(searcher, qv, cands):
+    if isinstance(searcher, ShardedSearcher):
+        return searcher.score(qv, cands)
+    return [
+        searcher.reconstruct_batch(c) @ qv[row] if len(c) else np.zeros(0, dtype="float32")
+        for row, c in enumerate(cands)
+    ]
+
+def chunk_stage(searcher, qv, k):
+    scores, ids = searcher.search(qv, k)
+    return [
+        ([{"chunk_id": int(i), "score": float(s)} for i, s in zip(ids[row], scores[row]) if i >= 0], [])
+        for row in range(len(qv))
+    ]
+
+def page_stage(searcher, page_index, page_metas, qv, k):
+    """
+    Сначала top PAGE_TOP страниц по постраничному индексу, потом ранжируем
+    только чанки этих страниц. Скор страницы — PAGE_AGG по скорам её чанков,
+    от каждой страницы берём до CHUNKS_PER_PAGE лучших чанков, и все они
+    сортируются вместе по скору чанка.
+    """
+    _, p_ids = page_index.search(qv, PAGE_TOP)
+    rows_pages = [[int(p) for p in row if p >= 0] for row in p_ids]
+    cands = [
+        np.asarray([c for p in pages for c in page_metas[p]["chunk_ids"]], dtype="int64")
+        for pages in rows_pages
+    ]
+    scored = score_chunks(searcher, qv, cands)
+
+    out = []
+    for pages, cand, sc in zip(rows_pages, cands, scored):
+        ranked = []
+        pos = 0
+        for p in pages:
+            n = len(page_metas[p]["chunk_ids"])
+            c, s = cand[pos:pos + n], sc[pos:pos + n]
+            pos += n
+            agg = float(s.max()) if PAGE_AGG == "max" else float(s.sum())
+            ranked.append((agg, p, c, s))
+        ranked.sort(key=lambda x: x[0], reverse=True)
+
+        hits, page_recs = [], []
+        for page_rank, (agg, p, c, s) in enumerate(ranked, start=1):
+            page_recs.append({
+                "pdf_name": page_metas[p]["pdf_name"],
+                "page_index": page_metas[p]["page_index"],
+                "score": agg,
+            })
+            for j in np.argsort(-s, kind="stable")[:CHUNKS_PER_PAGE]:
+                hits.append({
+                    "chunk_id": int(c[j]),
+                    "score": float(s[j]),
+                    "page_score": agg,
+                    "page_rank": page_rank,
+                })
+        hits.sort(key=lambda h: h["score"], reverse=True)
+        out.append((hits[:k], page_recs))
+    return out
+
+def main():
     if not QUESTIONS_PATH.exists():
         raise SystemExit(f"Нет файла вопросов: {QUESTIONS_PATH}")
 
-    metas = list(read_jsonl(META_PATH))
-    texts = [rec["text"] for rec in read_jsonl(CHUNKS_PATH)]
-
-    index = faiss.read_index(str(INDEX_PATH))
+    searcher = open_searcher()
+    if TWO_STAGE:
+        if not PAGES_INDEX_PATH.exists():
+            raise SystemExit("Нет постраничного индекса. Запусти index_faiss.py")
+        page_index = faiss.read_index(str(PAGES_INDEX_PATH))
+        page_metas = list(read_jsonl(PAGES_META_PATH))
     model = SentenceTransformer(MODEL_NAME)
 
-    questions = load_questions(QUESTIONS_PATH)
+    questions = [(q or "").strip() for q in load_questions(QUESTIONS_PATH)]
 
     k = 50
+    # эмбеддим и ищем батчами, а не по одному вопросу
+    asked = [qi for qi, q in enumerate(questions) if q]
+    found = {}
+    try:
+        for start in range(0, len(asked), QUERY_BATCH):
+            batch = asked[start:start + QUERY_BATCH]
+            qv = model.encode([questions[qi] for qi in batch], normalize_embeddings=True).astype("float32")
+            if TWO_STAGE:
+                results = page_stage(searcher, page_index, page_metas, qv, k)
+            else:
+                results = chunk_stage(searcher, qv, k)
+            for qi, res in zip(batch, results):
+                found[qi] = res
+    finally:
+        if isinstance(searcher, ShardedSearcher):
+            searcher.close()
+
+    stage = "page" if TWO_STAGE else "chunk"
+    fingerprint = chunks_fingerprint(CHUNKS_PATH)
     with OUT_PATH.open("w", encoding="utf-8") as f_out:
         for qi, q in enumerate(questions):
-            q = (q or "").strip()
-            if not q:
-                # сохраняем пустой вопрос как запись без hits, чтобы порядок не ломался
-                rec = {"question_index": qi, "question": q, "hits": []}
-                f_out.write(json.dumps(rec, ensure_ascii=False) + "\n")
-                continue
-
-            qv = model.encode([q], normalize_embeddings=True).astype("float32")
-            scores, ids = index.search(qv, k)
-
-            hits = []
-            for idx, score in zip(ids[0], scores[0]):
-                m = metas[idx]
-                hits.append({
-                    "score": float(score),
-                    "pdf_name": m["pdf_name"],
-                    "page_index": m["page_index"],
-                    "text": texts[idx]
-                })
-
-
-
-            rec = {
-                "question_index": qi,
-                "question": q,
-                "hits": hits
-            }
+            # пустой вопрос сохраняем как запись без hits, чтобы порядок не ломался
+            found_hits, pages = found.get(qi, ([], []))
+            rec = to_compact(qi, q, found_hits, stage, pages, chunks=fingerprint)
             f_out.write(json.dumps(rec, ensure_ascii=False) + "\n")
 
     print("Готово:", OUT_PATH)
 
+    if WRITE_LEGACY:
+        store = ChunkStore(CHUNKS_PATH)
+        with LEGACY_OUT_PATH.open("w", encoding="utf-8") as f_out:
+            for qi, q in enumerate(questions):
+                found_hits, pages = found.get(qi, ([], []))
+                rec = {
+                    "question_index": qi,
+                    "question": q,
+                    "hits": resolve_hits(to_compact(qi, q, found_hits, stage, chunks=fingerprint), store)
+                }
+                if TWO_STAGE:
+                    rec["pages"] = pages
+                f_out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        store.close()
+        print("Готово:", LEGACY_OUT_PATH)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,143 @@
+from pathlib import Path
+from array import array
+import hashlib
+import json
+from typing import Any, Dict, List, Optional
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+CHUNKS_PATH = BASE_DIR / "data" / "chunks.jsonl"
+
+# компактный retrieval: только номера чанков (строки chunks.jsonl), скоры и этап поиска
+RETRIEVED_IDS_PATH = BASE_DIR / "data" / "retrieved_ids.jsonl"
+
+
+def chunks_fingerprint(chunks_path: Path) -> str:
+    """
+    Отпечаток chunks.jsonl: размер, число строк и sha1 содержимого.
+    Компактный retrieval хранит только номера строк, поэтому без него
+    пересобранный chunks.jsonl молча подсунул бы не те чанки.
+    """
+    h = hashlib.sha1()
+    size = lines = 0
+    with chunks_path.open("rb") as f:
+        while True:
+            b = f.read(1024 * 1024)
+            if not b:
+                break
+            h.update(b)
+            size += len(b)
+            lines += b.count(b"\n")
+    return f"{size}:{lines}:{h.hexdigest()}"
+
+
+def offsets_path(chunks_path: Path) -> Path:
+    return chunks_path.with_suffix(".offsets")
+
+
+def build_offsets(chunks_path: Path) -> array:
+    offsets = array("q")
+    pos = 0
+    with chunks_path.open("rb") as f:
+        for line in f:
+            offsets.append(pos)
+            pos += len(line)
+    with offsets_path(chunks_path).open("wb") as f:
+        offsets.tofile(f)
+    return offsets
+
+
+def load_offsets(chunks_path: Path) -> array:
+    path = offsets_path(chunks_path)
+    if not path.exists() or path.stat().st_mtime < chunks_path.stat().st_mtime:
+        return build_offsets(chunks_path)
+    offsets = array("q")
+    with path.open("rb") as f:
+        offsets.frombytes(f.read())
+    if offsets and offsets[-1] >= chunks_path.stat().st_size:
+        return build_offsets(chunks_path)
+    return offsets
+
+
+class ChunkStore:
+    """
+    Чтение chunks.jsonl по номеру чанка без загрузки всего файла:
+    смещения строк лежат рядом в chunks.offsets и пересобираются, если устарели.
+    """
+
+    def __init__(self, chunks_path: Path = CHUNKS_PATH):
+        self.path = chunks_path
+        self.fingerprint = chunks_fingerprint(chunks_path)
+        self.offsets = load_offsets(chunks_path)
+        self._f = chunks_path.open("rb")
+        self._cache: Dict[int, dict] = {}
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def get(self, chunk_id: int) -> dict:
+        rec = self._cache.get(chunk_id)
+        if rec is None:
+            self._f.seek(self.offsets[chunk_id])
+            rec = json.loads(self._f.readline())
+            self._cache[chunk_id] = rec
+        return rec
+
+    def check(self, fingerprint: Optional[str]):
+        if fingerprint != self.fingerprint:
+            raise ValueError(
+                f"retrieved_ids.jsonl собран по другому {self.path.name} "
+                f"({fingerprint or 'без отпечатка'} != {self.fingerprint}). Перезапусти batch_retrieve.py"
+            )
+
+    def close(self):
+        self._f.close()
+
+
+def to_compact(question_index: int, question: str, hits: List[Dict[str, Any]], stage: str,
+               pages: Optional[List[Dict[str, Any]]] = None, *, chunks: str) -> dict:
+    """
+    hits — [{"chunk_id", "score", (+ "page_score", "page_rank" для stage="page")}],
+    pages — сводные скоры страниц первого этапа (для stage="page"),
+    chunks — chunks_fingerprint файла, в который указывают chunk_id.
+    Пишем колонками, текст не копируем.
+    """
+    rec: Dict[str, Any] = {
+        "question_index": question_index,
+        "question": question,
+        "chunks": chunks,
+        "stage": stage,
+        "chunk_ids": [h["chunk_id"] for h in hits],
+        "scores": [round(h["score"], 6) for h in hits],
+    }
+    if stage == "page":
+        rec["page_scores"] = [round(h["page_score"], 6) for h in hits]
+        rec["page_ranks"] = [h["page_rank"] for h in hits]
+        rec["pages"] = pages or []
+    return rec
+
+
+def resolve_hits(rec: dict, store: ChunkStore, k: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Хиты в старом формате retrieved.jsonl (с текстом) для первых k чанков
+    компактной записи. Старые записи с "hits" возвращаются как есть.
+    Если запись сделана по другому chunks.jsonl — ValueError.
+    """
+    if "chunk_ids" not in rec:
+        return (rec.get("hits") or [])[:k]
+
+    store.check(rec.get("chunks"))
+
+    hits = []
+    for i, chunk_id in enumerate(rec["chunk_ids"][:k]):
+        c = store.get(chunk_id)
+        hit = {
+            "score": rec["scores"][i],
+            "pdf_name": c["pdf_name"],
+            "page_index": c["page_index"],
+            "text": c["text"],
+        }
+        if "page_scores" in rec:
+            hit["page_score"] = rec["page_scores"][i]
+            hit["page_rank"] = rec["page_ranks"][i]
+        hits.append(hit)
+    return hits
@@ -0,0 +1,63 @@
+from pathlib import Path
+import json
+from tqdm import tqdm
+from chunk_store import CHUNKS_PATH, RETRIEVED_IDS_PATH, chunks_fingerprint, to_compact
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+LEGACY_PATH = BASE_DIR / "data" / "retrieved.jsonl"
+
+def read_jsonl(path: Path):
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def main():
+    """
+    Переводит старый retrieved.jsonl (текст в каждом хите) в компактный
+    retrieved_ids.jsonl: хит ищем в chunks.jsonl по (pdf_name, page_index, text).
+    """
+    if not LEGACY_PATH.exists():
+        raise SystemExit(f"Нет файла: {LEGACY_PATH}")
+    if not CHUNKS_PATH.exists():
+        raise SystemExit("Нет chunks.jsonl. Запусти build_index.py")
+
+    chunk_ids = {}
+    for chunk_id, rec in enumerate(read_jsonl(CHUNKS_PATH)):
+        chunk_ids.setdefault((rec["pdf_name"], rec["page_index"], rec["text"]), chunk_id)
+
+    # этап один на весь файл: у пустого вопроса двухэтапного поиска хитов нет
+    stage = "chunk"
+    for rec in read_jsonl(LEGACY_PATH):
+        if "pages" in rec or any("page_score" in h for h in rec.get("hits") or []):
+            stage = "page"
+            break
+
+    fingerprint = chunks_fingerprint(CHUNKS_PATH)
+    missing = 0
+    with RETRIEVED_IDS_PATH.open("w", encoding="utf-8") as f_out:
+        for qi, rec in enumerate(tqdm(read_jsonl(LEGACY_PATH), desc="Converting")):
+            old_hits = rec.get("hits") or []
+            hits = []
+            for h in old_hits:
+                chunk_id = chunk_ids.get((h.get("pdf_name"), h.get("page_index"), h.get("text")))
+                if chunk_id is None:
+                    # retrieved.jsonl от другой версии chunks.jsonl
+                    missing += 1
+                    continue
+                hit = {"chunk_id": chunk_id, "score": float(h.get("score", 0.0))}
+                if stage == "page":
+                    hit["page_score"] = float(h.get("page_score", 0.0))
+                    hit["page_rank"] = int(h.get("page_rank", 0))
+                hits.append(hit)
+            out = to_compact(rec.get("question_index", qi), rec.get("question", ""), hits, stage, rec.get("pages"),
+                             chunks=fingerprint)
+            f_out.write(json.dumps(out, ensure_ascii=False) + "\n")
+
+    print("Готово:", RETRIEVED_IDS_PATH)
+    if missing:
+        print(f"Не нашёл в chunks.jsonl хитов: {missing}")
+
+if __name__ == "__main__":
+    main()
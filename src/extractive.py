@@ -22,9 +22,20 @@ def extract_number(question: str, hits: list[dict]):
     Возвращает (число, hit) или (None, None)
     Идея: выбрать число, рядом с которым есть слова вопроса.
     """
+    best = extract_number_scored(question, hits)
+    if best is None:
+        return None, None
+    return best[1], best[2]
+
+def extract_number_scored(question: str, hits: list[dict]):
+    """
+    То же, что extract_number, но возвращает (score, число, hit) или None.
+    score — сколько слов вопроса рядом с числом (+2, если рядом год из вопроса).
+    Число уже домножено на единицы из окна (thousand/million/billion).
+    """
     kw, years = _keywords(question)
 
-    best = None  # (score, value, hit)
+    best = None  # (score, value, hit, window)
     for h in hits:
         txt = h.get("text", "")
         low = txt.lower()
@@ -57,23 +68,22 @@ def extract_number(question: str, hits: list[dict]):
             score = hit_kw + 0.1 * bonus
 
             if best is None or score > best[0]:
-                best = (score, val, h)
+                best = (score, val, h, window)
 
     if best is None:
-        return None, None
-    window = low[s:e]
+        return None
+    score, val, h, window = best
 
     mult = 1.0
-    if "million" in window or "mn" in window:
-        mult = 1_000_000.0
-    elif "billion" in window or "bn" in window:
+    if re.search(r"\b(billions?|bn)\b", window):
         mult = 1_000_000_000.0
-    elif "thousand" in window or "in thousands" in window:
+    elif re.search(r"\b(millions?|mn)\b", window):
+        mult = 1_000_000.0
+    elif re.search(r"\bthousands?\b", window):
         mult = 1_000.0
 
-    val = val * mult
     if years:
         hit_year = any(y in window for y in years)
         score = score + (2.0 if hit_year else 0.0)
 
-    return best[1], best[2]
+    return score, val * mult, h
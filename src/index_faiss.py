@@ -4,19 +4,109 @@ import numpy as np
 import faiss
 from tqdm import tqdm
 from sentence_transformers import SentenceTransformer
+from sharded_search import SHARDS_DIR, shard_of, shard_index_path, shard_meta_path
 
 BASE_DIR = Path(__file__).resolve().parents[1]
 CHUNKS_PATH = BASE_DIR / "data" / "chunks.jsonl"
 INDEX_PATH = BASE_DIR / "data" / "faiss.index"
 META_PATH = BASE_DIR / "data" / "faiss_meta.jsonl"
+PAGES_INDEX_PATH = BASE_DIR / "data" / "faiss_pages.index"
+PAGES_META_PATH = BASE_DIR / "data" / "faiss_pages_meta.jsonl"
 
 MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 
+# N_SHARDS > 1: вместо одного индекса пишем шарды по диапазонам хэша PDF (см. sharded_search.py)
+N_SHARDS = 1
+
 def read_jsonl(path: Path):
     with path.open("r", encoding="utf-8") as f:
         for line in f:
             yield json.loads(line)
 
+def encode(model, texts):
+    return model.encode(
+        texts,
+        batch_size=64,
+        show_progress_bar=True,
+        normalize_embeddings=True,
+    ).astype("float32")
+
+def pool_pages(emb, chunk_ids, metas):
+    """
+    Один вектор на страницу: среднее нормированных эмбеддингов её чанков.
+    emb[row] — эмбеддинг чанка chunk_ids[row].
+    """
+    pages = {}
+    for row, chunk_id in enumerate(chunk_ids):
+        m = metas[chunk_id]
+        pages.setdefault((m["pdf_name"], m["page_index"]), []).append(row)
+
+    vecs = np.zeros((len(pages), emb.shape[1]), dtype="float32")
+    page_metas = []
+    for i, ((pdf_name, page_index), rows) in enumerate(pages.items()):
+        v = emb[rows].mean(axis=0)
+        vecs[i] = v / max(float(np.linalg.norm(v)), 1e-12)
+        page_metas.append({
+            "pdf_name": pdf_name,
+            "page_index": page_index,
+            "chunk_ids": [int(chunk_ids[r]) for r in rows],
+        })
+    return vecs, page_metas
+
+def write_pages(vecs, page_metas):
+    index = faiss.IndexFlatIP(vecs.shape[1])
+    index.add(vecs)
+    faiss.write_index(index, str(PAGES_INDEX_PATH))
+
+    with PAGES_META_PATH.open("w", encoding="utf-8") as f:
+        for m in page_metas:
+            f.write(json.dumps(m, ensure_ascii=False) + "\n")
+
+    print(" -", PAGES_INDEX_PATH)
+    print("Страниц:", index.ntotal)
+
+def write_shards(model, texts, metas, n_shards: int):
+    SHARDS_DIR.mkdir(parents=True, exist_ok=True)
+
+    # chunk_id — номер строки в chunks.jsonl, по нему батч-поиск достаёт текст
+    by_shard = [[] for _ in range(n_shards)]
+    for chunk_id, m in enumerate(metas):
+        by_shard[shard_of(m["pdf_name"], n_shards)].append(chunk_id)
+
+    dim = model.get_sentence_embedding_dimension()
+    total = 0
+    page_vecs, page_metas = [], []
+    for shard, chunk_ids in enumerate(by_shard):
+        # эмбеддим шард за шардом, чтобы не держать в памяти весь корпус
+        index = faiss.IndexFlatIP(dim)
+        if chunk_ids:
+            emb = encode(model, [texts[i] for i in chunk_ids])
+            index.add(emb)
+            # страница целиком лежит в одном шарде (шардируем по PDF)
+            vecs, shard_pages = pool_pages(emb, chunk_ids, metas)
+            page_vecs.append(vecs)
+            page_metas.extend(shard_pages)
+        faiss.write_index(index, str(shard_index_path(shard)))
+
+        with shard_meta_path(shard).open("w", encoding="utf-8") as f:
+            for i in chunk_ids:
+                f.write(json.dumps({"chunk_id": i, **metas[i]}, ensure_ascii=False) + "\n")
+
+        print(f" - шард {shard}: {index.ntotal} векторов")
+        total += index.ntotal
+
+    # старые шарды с большими номерами сбили бы count_shards()
+    stale = n_shards
+    while shard_index_path(stale).exists():
+        shard_index_path(stale).unlink()
+        shard_meta_path(stale).unlink(missing_ok=True)
+        stale += 1
+
+    print("Готово:", SHARDS_DIR)
+    print("Векторов:", total)
+    if page_vecs:
+        write_pages(np.concatenate(page_vecs), page_metas)
+
 def main():
     if not CHUNKS_PATH.exists():
         raise SystemExit("Сначала запусти build_index.py чтобы появился chunks.jsonl")
@@ -29,13 +119,12 @@ def main():
         texts.append(rec["text"])
         metas.append({"pdf_name": rec["pdf_name"], "page_index": rec["page_index"]})
 
+    if N_SHARDS > 1:
+        write_shards(model, texts, metas, N_SHARDS)
+        return
+
     # эмбеддинги
-    emb = model.encode(
-        texts,
-        batch_size=64,
-        show_progress_bar=True,
-        normalize_embeddings=True,
-    ).astype("float32")
+    emb = encode(model, texts)
 
     dim = emb.shape[1]
     index = faiss.IndexFlatIP(dim)  # cosine ~ inner product при normalize_embeddings=True
@@ -51,6 +140,7 @@ def main():
     print(" -", INDEX_PATH)
     print(" -", META_PATH)
     print("Векторов:", index.ntotal)
+    write_pages(*pool_pages(emb, range(len(metas)), metas))
 
 if __name__ == "__main__":
     main()
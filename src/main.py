@@ -3,17 +3,24 @@ from __future__ import annotations
 from pathlib import Path
 import json
 import hashlib
+import math
 import re
 from typing import Any, Dict, List, Tuple, Optional
 
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import AIMessage, HumanMessage
+
+from extractive import extract_number_scored
+from chunk_store import CHUNKS_PATH, RETRIEVED_IDS_PATH, ChunkStore, resolve_hits
 
 
 BASE_DIR = Path(__file__).resolve().parents[1]
 
 QUESTIONS_PATH = BASE_DIR / "data" / "questions.json"
-RETRIEVED_PATH = BASE_DIR / "data" / "retrieved.jsonl"
+# компактный retrieved_ids.jsonl (тексты берём из chunks.jsonl по мере надобности);
+# если его нет — старый retrieved.jsonl с текстами в хитах
+RETRIEVED_PATH = RETRIEVED_IDS_PATH
+LEGACY_RETRIEVED_PATH = BASE_DIR / "data" / "retrieved.jsonl"
 PDF_DIR = BASE_DIR / "data" / "pdfs"
 
 OUT_PATH = BASE_DIR / "motovilova_v9.json"
@@ -23,13 +30,32 @@ SUBMISSION_NAME = "motovilova_v9"
 
 TOP_K_HITS = 20
 
+# стримим ответ модели и закрываем запрос, как только пришёл полный JSON-объект
+STREAM = True
+
+
+# модели каскада (см. CASCADE): дешёвая с коротким контекстом и полная;
+# по умолчанию обе — модель из исходного пайплайна
+SMALL_MODEL = "gpt-5-nano"
+FULL_MODEL = "gpt-5-nano"
+
+# локальная ступень: сколько слов вопроса должно быть рядом с числом,
+# чтобы вообще спрашивать cross-encoder о его уверенности
+EXTRACTIVE_MIN_KEYWORDS = 2
+
 
 llm = ChatOpenAI(
-    model="gpt-5-nano",
+    model=FULL_MODEL,
     temperature=0,
     timeout=120,
 )
 
+llm_small = ChatOpenAI(
+    model=SMALL_MODEL,
+    temperature=0,
+    timeout=60,
+)
+
 
 _SHA1_CACHE: Dict[str, str] = {}
 
@@ -127,21 +153,107 @@ def is_empty_value(value: Any, kind: str) -> bool:
     return value is None or str(value).strip() == ""
 
 
+_JSON_DECODER = json.JSONDecoder()
+
+
+def first_json_object(s: str) -> Optional[dict]:
+    """
+    Первый сбалансированный JSON-объект в строке (в отличие от жадного regex
+    не склеивает несколько объектов и не цепляет хвост после ответа).
+    """
+    pos = s.find("{")
+    while pos != -1:
+        try:
+            obj, _ = _JSON_DECODER.raw_decode(s, pos)
+        except ValueError:
+            obj = None
+        if isinstance(obj, dict):
+            return obj
+        pos = s.find("{", pos + 1)
+    return None
+
+
 def safe_json_loads(s: str) -> Optional[dict]:
     if not s:
         return None
     s = s.strip()
     try:
-        return json.loads(s)
+        data = json.loads(s)
+        if isinstance(data, dict):
+            return data
     except Exception:
         pass
-    m = re.search(r"\{.*\}", s, re.S)
-    if not m:
-        return None
+    return first_json_object(s)
+
+
+def stream_json_answer(model: Any, messages: List[Any]) -> Tuple[str, Optional[dict]]:
+    """
+    Читает ответ модели по токенам и обрывает стрим, как только разобран
+    объект с ключами value и support_ids.
+    """
+    buf = ""
+    stream = model.stream(messages)
     try:
-        return json.loads(m.group(0))
-    except Exception:
-        return None
+        for chunk in stream:
+            piece = chunk.content if isinstance(chunk.content, str) else ""
+            if not piece:
+                continue
+            buf += piece
+            if "}" not in piece:
+                continue
+            data = first_json_object(buf)
+            if data is not None and "value" in data and "support_ids" in data:
+                return clean_text(buf), data
+    finally:
+        stream.close()
+    raw = clean_text(buf)
+    return raw, safe_json_loads(raw)
+
+
+def ask_llm(model: Any, messages: List[Any]) -> Tuple[str, Optional[dict]]:
+    if STREAM:
+        return stream_json_answer(model, messages)
+    resp = model.invoke(messages)
+    raw = clean_text(resp.content or "")
+    return raw, safe_json_loads(raw)
+
+
+def validate_answer(data: Optional[dict], kind: str, n_blocks: int) -> Optional[str]:
+    """
+    Проверяет ответ модели против формата из build_prompt.
+    Возвращает текст ошибки для repair-промпта или None, если всё ок.
+    """
+    if data is None:
+        return "output is not a JSON object"
+    if "value" not in data:
+        return 'missing key "value"'
+    value = data["value"]
+    if kind == "boolean":
+        if not isinstance(value, bool):
+            return '"value" must be true or false'
+    elif kind == "number":
+        if value != "N/A" and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            return '"value" must be a JSON number or "N/A"'
+    elif kind in ("name", "names"):
+        if not isinstance(value, str) or not value.strip():
+            return '"value" must be a non-empty string or "N/A"'
+    elif value is None:
+        return '"value" must not be null'
+
+    support_ids = data.get("support_ids")
+    if not isinstance(support_ids, list):
+        return '"support_ids" must be a list of block IDs'
+    for sid in support_ids:
+        if isinstance(sid, bool) or not isinstance(sid, int) or not 1 <= sid <= n_blocks:
+            return f'"support_ids" must contain only block IDs from 1 to {n_blocks}'
+    return None
+
+
+def build_repair_prompt(kind: str, error: str) -> str:
+    return f"""
+Your previous answer is invalid: {error}.
+Reply again with ONLY the corrected JSON object for question type {kind}, no other text.
+""".strip()
 
 
 def build_numbered_context(hits: List[Dict[str, Any]], k: int) -> str:
@@ -156,7 +268,7 @@ def build_numbered_context(hits: List[Dict[str, Any]], k: int) -> str:
     return "\n\n".join(blocks)
 
 
-def build_prompt(question: str, kind: str, context: str) -> str:
+def build_prompt(question: str, kind: str, context: str, hint: Optional[str] = None) -> str:
     if kind == "boolean":
         rule = "Return True only if the statement is clearly supported by at least one context block. Otherwise return False."
         out = '{"value": true/false, "support_ids": [1,2,...]}'
@@ -173,6 +285,8 @@ def build_prompt(question: str, kind: str, context: str) -> str:
         rule = "Return the answer only if supported. Otherwise return N/A."
         out = '{"value": "..." or "N/A", "support_ids": [1,2,...]}'
 
+    hint_block = f"\n{hint}\n" if hint else ""
+
     return f"""
 You must answer using ONLY the context blocks below.
 
@@ -186,7 +300,7 @@ If not found, support_ids must be [].
 
 Question type: {kind}
 Question: {question}
-
+{hint_block}
 Context blocks:
 {context}
 """.strip()
@@ -216,39 +330,177 @@ def pick_refs_from_support(hits: List[Dict[str, Any]], support_ids: List[int]) -
     return refs
 
 
-def answer_question(q_text: str, kind: str, hits: List[Dict[str, Any]]) -> Tuple[Any, List[Dict[str, Any]]]:
-    hits = (hits or [])[:TOP_K_HITS]
-    context = build_numbered_context(hits, TOP_K_HITS)
-
-    if not context.strip():
-        if kind == "boolean":
-            return False, []
-        if kind == "number":
-            return "N/A", []
-        return "N/A", []
-
-    prompt = build_prompt(q_text, kind, context)
-    resp = llm.invoke([HumanMessage(content=prompt)])
-    raw = clean_text(resp.content or "")
-
-    data = safe_json_loads(raw) or {}
+def normalize_value(value_raw: Any, kind: str) -> Any:
+    if kind == "boolean":
+        return norm_boolean(value_raw)
+    if kind == "number":
+        return norm_number(value_raw)
+    if kind == "name":
+        return norm_name(value_raw)
+    if kind == "names":
+        return norm_names(value_raw)
+    value = clean_text(str(value_raw)) if value_raw is not None else "N/A"
+    return value or "N/A"
+
+
+def is_supported(value: Any, kind: str, hits: List[Dict[str, Any]], support_ids: List[int]) -> bool:
+    """
+    Грубая проверка, что support_ids действительно подтверждают значение:
+    число/имя должно встречаться в тексте указанных блоков.
+    """
+    if not support_ids:
+        return False
+    text = " ".join(clean_text(hits[i - 1].get("text", "")) for i in support_ids)
+    text = re.sub(r"\s+", " ", text).lower()
+    if kind == "number":
+        target = abs(float(value))
+        for m in re.findall(r"\d[\d,]*(?:\.\d+)?", text):
+            try:
+                num = float(m.replace(",", ""))
+            except ValueError:
+                continue
+            # в отчётах числа часто "in thousands/millions"
+            if any(abs(num * scale - target) <= 1e-9 * max(target, 1.0) for scale in (1, 1e3, 1e6, 1e9)):
+                return True
+        return False
+    if kind == "name":
+        return value.lower() in text
+    if kind == "names":
+        return all(part.lower() in text for part in value.split(", "))
+    return True
+
+
+def escalation_reason(data: Optional[dict], error: Optional[str], kind: str,
+                      hits: List[Dict[str, Any]], low_confidence: bool = False) -> Optional[str]:
+    if error:
+        return "invalid"
+    value = normalize_value(data.get("value"), kind)
+    # boolean false тоже "пустой": дешёвая ступень могла не увидеть нужный блок
+    if is_empty_value(value, kind):
+        return "empty"
+    if not is_supported(value, kind, hits, data["support_ids"]):
+        return "unsupported"
+    if low_confidence:
+        return "low_confidence"
+    return None
+
+
+def format_number(value: float) -> str:
+    # без экспоненты: 1.5e+09 -> 1500000000
+    return f"{value:f}".rstrip("0").rstrip(".")
+
+
+def extractive_answer(q_text: str, kind: str, hits: List[Dict[str, Any]]) -> Tuple[Optional[dict], float]:
+    """
+    Локальная ступень каскада для number, без LLM: число от extractive.py,
+    уверенность — вероятность cross-encoder'а (rerank.py), что блок с этим
+    числом отвечает на вопрос. Если слов вопроса рядом с числом меньше
+    EXTRACTIVE_MIN_KEYWORDS, уверенность 0.
+    """
+    if kind != "number":
+        return None, 0.0
+    best = extract_number_scored(q_text, hits)
+    if best is None:
+        return None, 0.0
+    score, value, hit = best
+    sid = next(i for i, h in enumerate(hits, start=1) if h is hit)
+    data = {"value": value, "support_ids": [sid]}
+    if score < EXTRACTIVE_MIN_KEYWORDS:
+        return data, 0.0
+
+    # rerank.py грузит CrossEncoder при импорте, поэтому только когда он нужен
+    from rerank import rerank
+    logit = rerank(q_text, [dict(hit)], top_n=1)[0]["rerank_score"]
+    return data, 1.0 / (1.0 + math.exp(-logit))
+
+
+def extractive_hint(q_text: str, kind: str, hits: List[Dict[str, Any]]) -> Optional[str]:
+    """Подсказка дешёвой LLM-ступени от extractive.py: число рядом со словами вопроса."""
+    if kind != "number":
+        return None
+    best = extract_number_scored(q_text, hits)
+    if best is None:
+        return None
+    _, value, hit = best
+    sid = next(i for i, h in enumerate(hits, start=1) if h is hit)
+    return (f"Hint from a keyword matcher (may be wrong): the value might be {format_number(value)} "
+            f"from block {sid}. Verify it against the context before using it.")
+
+
+def ask_tier(model: Any, q_text: str, kind: str, hits: List[Dict[str, Any]],
+             repair: bool, hint: Optional[str] = None) -> Tuple[Optional[dict], Optional[str], int, int, int]:
+    """
+    Один LLM-запрос по hits (+ не более одного короткого repair, если repair=True).
+    Возвращает (data, ошибка валидации или None, символов на входе,
+    символов на выходе, число запросов к модели).
+    """
+    prompt = build_prompt(q_text, kind, build_numbered_context(hits, len(hits)), hint)
+    messages: List[Any] = [HumanMessage(content=prompt)]
+    raw, data = ask_llm(model, messages)
+    chars_in, chars_out, requests = len(prompt), len(raw), 1
+
+    error = validate_answer(data, kind, len(hits))
+    if error and repair:
+        messages += [AIMessage(content=raw), HumanMessage(content=build_repair_prompt(kind, error))]
+        chars_in += sum(len(m.content) for m in messages)
+        raw, data = ask_llm(model, messages)
+        chars_out += len(raw)
+        requests += 1
+        error = validate_answer(data, kind, len(hits))
+    return data, error, chars_in, chars_out, requests
+
+
+# Каскад ответов: ступени по порядку, дешёвые первыми. Следующая ступень
+# берёт вопрос при невалидном или пустом ответе (в т.ч. boolean false),
+# support_ids, которые не подтверждают значение, или уверенности ниже
+# min_confidence. Последняя подходящая ступень отвечает в любом случае
+# (с repair-запросом).
+# answerer(q_text, kind, hits) -> (data, confidence) — локальная ступень без LLM;
+# llm + top_k — модель и сколько блоков контекста ей давать;
+# hint(q_text, kind, hits) -> строка-подсказка в промпт или None;
+# kinds — для каких типов вопросов ступень включена (None — для всех);
+# price_in/price_out — $ за 1M токенов, токены оцениваем как символы / 4.
+CASCADE: List[Dict[str, Any]] = [
+    {"name": "extractive", "answerer": extractive_answer, "kinds": ("number",), "min_confidence": 0.9},
+    {"name": "small", "llm": llm_small, "top_k": 5, "kinds": ("boolean", "number"),
+     "hint": extractive_hint, "price_in": 0.05, "price_out": 0.40},
+    {"name": "full", "llm": llm, "top_k": TOP_K_HITS, "price_in": 0.05, "price_out": 0.40},
+]
+
+CASCADE_STATS: Dict[str, Dict[str, Any]] = {}
+
+
+def tier_stats(stats: Dict[str, Dict[str, Any]], name: str) -> Dict[str, Any]:
+    return stats.setdefault(name, {
+        "questions": 0, "accepted": 0, "invalid": 0, "escalated": {},
+        "llm_calls": 0, "repairs": 0, "tokens_in": 0, "tokens_out": 0, "cost": 0.0,
+    })
+
+
+def format_cascade_report(stats: Dict[str, Dict[str, Any]]) -> str:
+    lines = ["Cascade:"]
+    total = 0.0
+    for name, st in stats.items():
+        rate = st["accepted"] / st["questions"] if st["questions"] else 0.0
+        esc = ", ".join(f"{r}={c}" for r, c in sorted(st["escalated"].items())) or "-"
+        lines.append(
+            f"  {name}: questions={st['questions']} accepted={st['accepted']} ({rate:.0%}) "
+            f"invalid={st['invalid']} escalated[{esc}] llm_calls={st['llm_calls']} repairs={st['repairs']} "
+            f"~tokens in/out={st['tokens_in']}/{st['tokens_out']} ~${st['cost']:.4f}"
+        )
+        total += st["cost"]
+    lines.append(f"  total ~${total:.4f}")
+    return "\n".join(lines)
+
+
+def finalize_answer(data: Optional[dict], kind: str, hits: List[Dict[str, Any]]) -> Tuple[Any, List[Dict[str, Any]]]:
+    data = data or {}
     value_raw = data.get("value", None)
     support_ids = data.get("support_ids", [])
     if not isinstance(support_ids, list):
         support_ids = []
 
-    if kind == "boolean":
-        value = norm_boolean(value_raw)
-    elif kind == "number":
-        value = norm_number(value_raw)
-    elif kind == "name":
-        value = norm_name(value_raw)
-    elif kind == "names":
-        value = norm_names(value_raw)
-    else:
-        value = clean_text(str(value_raw)) if value_raw is not None else "N/A"
-        if not value:
-            value = "N/A"
+    value = normalize_value(value_raw, kind)
 
     if is_empty_value(value, kind):
         return value, []
@@ -261,17 +513,85 @@ def answer_question(q_text: str, kind: str, hits: List[Dict[str, Any]]) -> Tuple
     return value, refs
 
 
+def answer_question(q_text: str, kind: str, hits: List[Dict[str, Any]],
+                    cascade: Optional[List[Dict[str, Any]]] = None,
+                    stats: Optional[Dict[str, Dict[str, Any]]] = None) -> Tuple[Any, List[Dict[str, Any]]]:
+    cascade = CASCADE if cascade is None else cascade
+    stats = CASCADE_STATS if stats is None else stats
+
+    hits = (hits or [])[:TOP_K_HITS]
+    context = build_numbered_context(hits, TOP_K_HITS)
+
+    if not context.strip():
+        if kind == "boolean":
+            return False, []
+        if kind == "number":
+            return "N/A", []
+        return "N/A", []
+
+    tiers = [t for t in cascade if not t.get("kinds") or kind in t["kinds"]]
+    data = None
+    for n, tier in enumerate(tiers):
+        final = n == len(tiers) - 1
+        st = tier_stats(stats, tier["name"])
+        st["questions"] += 1
+
+        if "answerer" in tier:
+            data, confidence = tier["answerer"](q_text, kind, hits)
+            error = validate_answer(data, kind, len(hits))
+            low_confidence = confidence < tier.get("min_confidence", 0.0)
+        else:
+            tier_hits = hits[:tier.get("top_k", TOP_K_HITS)]
+            hint = tier["hint"](q_text, kind, tier_hits) if tier.get("hint") else None
+            data, error, chars_in, chars_out, requests = ask_tier(
+                tier["llm"], q_text, kind, tier_hits, repair=final, hint=hint)
+            st["llm_calls"] += requests
+            st["repairs"] += requests - 1
+            st["tokens_in"] += chars_in // 4
+            st["tokens_out"] += chars_out // 4
+            st["cost"] += (chars_in * tier.get("price_in", 0.0) + chars_out * tier.get("price_out", 0.0)) / 4 / 1e6
+            low_confidence = False
+
+        reason = escalation_reason(data, error, kind, hits, low_confidence)
+        if reason is None or final:
+            if error:
+                # финальная ступень так и не дала валидный ответ: не нормализуем мусор,
+                # а отдаём значение по умолчанию без ссылок
+                st["invalid"] += 1
+                print(f"WARN invalid final answer ({error}), using default: {q_text[:80]!r}", flush=True)
+                data = None
+            else:
+                st["accepted"] += 1
+            break
+        st["escalated"][reason] = st["escalated"].get(reason, 0) + 1
+
+    return finalize_answer(data, kind, hits)
+
+
 def main():
     questions = json.load(open(QUESTIONS_PATH, encoding="utf-8"))
 
+    retrieved_path = RETRIEVED_PATH if RETRIEVED_PATH.exists() else LEGACY_RETRIEVED_PATH
+    store = ChunkStore(CHUNKS_PATH) if retrieved_path == RETRIEVED_PATH else None
+
     retrieved: List[Dict[str, Any]] = []
-    with open(RETRIEVED_PATH, encoding="utf-8") as f:
+    with open(retrieved_path, encoding="utf-8") as f:
         for line in f:
             line = line.strip()
             if not line:
                 continue
             retrieved.append(json.loads(line))
 
+    if store is not None:
+        # номера чанков имеют смысл только для того chunks.jsonl, по которому их нашли
+        stale = {r.get("chunks") for r in retrieved if "chunk_ids" in r} - {store.fingerprint}
+        if stale:
+            raise SystemExit(
+                f"{retrieved_path.name} собран по другому chunks.jsonl "
+                f"({', '.join(sorted(str(x) for x in stale))} != {store.fingerprint}). "
+                "Перезапусти batch_retrieve.py"
+            )
+
     n = min(len(questions), len(retrieved))
 
     answers: List[Dict[str, Any]] = []
@@ -282,7 +602,7 @@ def main():
 
         q_text = q["text"]
         kind = q.get("kind", "text")
-        hits = (r.get("hits") or [])
+        hits = resolve_hits(r, store, TOP_K_HITS)
 
         value, refs = answer_question(q_text, kind, hits)
 
@@ -295,6 +615,9 @@ def main():
         if (i + 1) % 20 == 0:
             print(f"Progress {i+1}/{n}", flush=True)
 
+    if store is not None:
+        store.close()
+
     submission = {
         "email": EMAIL,
         "submission_name": SUBMISSION_NAME,
@@ -307,6 +630,7 @@ def main():
     )
 
     print("DONE:", OUT_PATH, flush=True)
+    print(format_cascade_report(CASCADE_STATS), flush=True)
 
 
 if __name__ == "__main__":
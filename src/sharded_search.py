@@ -0,0 +1,172 @@
+from pathlib import Path
+import hashlib
+import json
+import multiprocessing as mp
+import numpy as np
+import faiss
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+SHARDS_DIR = BASE_DIR / "data" / "shards"
+
+
+def shard_index_path(shard: int) -> Path:
+    return SHARDS_DIR / f"faiss_{shard:03d}.index"
+
+
+def shard_meta_path(shard: int) -> Path:
+    return SHARDS_DIR / f"faiss_{shard:03d}_meta.jsonl"
+
+
+def shard_of(pdf_name: str, n_shards: int) -> int:
+    """
+    Номер шарда по диапазону хэша PDF.
+    Имена PDF — это их sha1, поэтому берём первые 32 бита имени;
+    для прочих имён хэшируем само имя.
+    """
+    stem = Path(pdf_name).stem
+    try:
+        h = int(stem[:8], 16)
+    except ValueError:
+        h = int(hashlib.sha1(pdf_name.encode("utf-8")).hexdigest()[:8], 16)
+    return (h * n_shards) >> 32
+
+
+def count_shards() -> int:
+    n = 0
+    while shard_index_path(n).exists():
+        n += 1
+    return n
+
+
+def read_chunk_ids(path: Path) -> np.ndarray:
+    ids = []
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            ids.append(json.loads(line)["chunk_id"])
+    return np.asarray(ids, dtype="int64")
+
+
+def merge_topk(scores_list, ids_list, k: int):
+    """
+    Сливает per-shard top-k (ids уже глобальные) в глобальный top-k.
+    Скоры и порядок те же, что у одного IndexFlatIP; точные совпадения скоров
+    упорядочиваем по id, чтобы результат не зависел от числа шардов.
+    Пустые позиции (id = -1) уходят в конец.
+    """
+    scores = np.concatenate(scores_list, axis=1)
+    ids = np.concatenate(ids_list, axis=1)
+    neg = np.where(ids < 0, np.inf, -scores)
+    out_scores = np.full((scores.shape[0], k), -np.inf, dtype="float32")
+    out_ids = np.full((scores.shape[0], k), -1, dtype="int64")
+    for row in range(scores.shape[0]):
+        order = np.lexsort((ids[row], neg[row]))[:k]
+        order = order[ids[row, order] >= 0]
+        out_scores[row, :len(order)] = scores[row, order]
+        out_ids[row, :len(order)] = ids[row, order]
+    return out_scores, out_ids
+
+
+def _score_owned(index, chunk_ids: np.ndarray, qv: np.ndarray, cands):
+    """
+    Скоры тех кандидатов (глобальные ids), что лежат в этом шарде.
+    chunk_ids шарда отсортированы — так их пишет index_faiss.py.
+    """
+    out = []
+    for row, cand in enumerate(cands):
+        pos = np.searchsorted(chunk_ids, cand)
+        pos_ok = np.minimum(pos, len(chunk_ids) - 1)
+        owned = (pos < len(chunk_ids)) & (chunk_ids[pos_ok] == cand)
+        where = np.nonzero(owned)[0]
+        if len(where):
+            scores = index.reconstruct_batch(pos[owned]) @ qv[row]
+        else:
+            scores = np.zeros(0, dtype="float32")
+        out.append((where, scores))
+    return out
+
+
+def _shard_worker(shard: int, conn):
+    # индекс шарда живёт только в этом процессе
+    faiss.omp_set_num_threads(1)
+    index = faiss.read_index(str(shard_index_path(shard)))
+    chunk_ids = read_chunk_ids(shard_meta_path(shard))
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        op, qv, arg = msg
+        if op == "score":
+            conn.send(_score_owned(index, chunk_ids, qv, arg) if index.ntotal else [])
+            continue
+        k = arg
+        if index.ntotal == 0:
+            empty = np.zeros((qv.shape[0], 0))
+            conn.send((empty.astype("float32"), empty.astype("int64")))
+            continue
+        scores, local = index.search(qv, min(k, index.ntotal))
+        global_ids = np.where(local < 0, -1, chunk_ids[np.maximum(local, 0)])
+        conn.send((scores, global_ids))
+    conn.close()
+
+
+class ShardedSearcher:
+    """
+    Scatter-gather поиск по шардам: каждый шард держит свой процесс,
+    батч запросов рассылается всем по pipe, ответы сливаются в общий top-k.
+    Результат совпадает с поиском по одному IndexFlatIP, но ids — номера
+    чанков в chunks.jsonl.
+    """
+
+    def __init__(self, n_shards: int | None = None):
+        self.n_shards = n_shards or count_shards()
+        if not self.n_shards:
+            raise FileNotFoundError(f"Нет шардов в {SHARDS_DIR}. Запусти index_faiss.py с N_SHARDS > 1")
+        self._conns = []
+        self._procs = []
+        for shard in range(self.n_shards):
+            parent, child = mp.Pipe()
+            p = mp.Process(target=_shard_worker, args=(shard, child), daemon=True)
+            p.start()
+            child.close()
+            self._conns.append(parent)
+            self._procs.append(p)
+
+    def search(self, qv: np.ndarray, k: int):
+        qv = np.ascontiguousarray(qv, dtype="float32")
+        for conn in self._conns:
+            conn.send(("search", qv, k))
+        parts = [conn.recv() for conn in self._conns]
+        return merge_topk([p[0] for p in parts], [p[1] for p in parts], k)
+
+    def score(self, qv: np.ndarray, cands):
+        """
+        Скоры заданных чанков для каждого запроса: cands[row] — массив
+        глобальных ids, результат выровнен с ним. Нужен второму этапу
+        постраничного поиска.
+        """
+        qv = np.ascontiguousarray(qv, dtype="float32")
+        cands = [np.asarray(c, dtype="int64") for c in cands]
+        for conn in self._conns:
+            conn.send(("score", qv, cands))
+        out = [np.full(len(c), -np.inf, dtype="float32") for c in cands]
+        for conn in self._conns:
+            for row, (where, scores) in enumerate(conn.recv()):
+                out[row][where] = scores
+        return out
+
+    def close(self):
+        for conn in self._conns:
+            try:
+                conn.send(None)
+                conn.close()
+            except (BrokenPipeError, OSError):
+                pass
+        for p in self._procs:
+            p.join()
+        self._conns, self._procs = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()